@@ -1,34 +1,22 @@
 import streamlit as st
-import pandas as pd
+import pyarrow as pa
 import os
 
+from data import (
+    BASE_DIR, load_table, load_monthly, load_yearly_kpis,
+    run_query, view_mtime
+)
+
 st.set_page_config(layout="wide")
 
 st.title("NYC Congestion Pricing Audit Dashboard")
 
 
-
-# ---------- Base Path ----------
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
 # ---------- Load Data ----------
-monthly_kpis = pd.read_parquet(
-    os.path.join(BASE_DIR, "monthly_kpis.parquet")
-)
-
-monthly_kpis["month"] = pd.to_datetime(monthly_kpis["month"])
-monthly_kpis = monthly_kpis.sort_values("month")
-
-zone_counts = pd.read_parquet(
-    os.path.join(BASE_DIR, "dashboard_zone_counts.parquet")
-)
-
-leakage = pd.read_parquet(
-    os.path.join(BASE_DIR, "dashboard_leakage.parquet")
-)
-
-velocity = pd.read_parquet(
-    os.path.join(BASE_DIR, "velocity_heatmap.parquet")
+monthly_kpis = load_monthly(
+    "monthly",
+    ["total_trips", "total_revenue", "congestion_revenue"],
+    view_mtime("monthly")
 )
 
 
@@ -36,13 +24,16 @@ velocity = pd.read_parquet(
 # ---------- KPI Overview ----------
 st.header("KPIs — Whole Year 2025")
 
-monthly_kpis["year"] = monthly_kpis["month"].dt.year
-kpi_2025 = monthly_kpis[monthly_kpis["year"] == 2025]
+# One grouped aggregation serves both the 2025 cards and the comparison
+yearly_kpis = load_yearly_kpis(view_mtime("monthly"))
+
+before = yearly_kpis.loc[2024]
+after = yearly_kpis.loc[2025]
 
-total_trips = kpi_2025["total_trips"].sum()
-total_revenue = kpi_2025["total_revenue"].sum()
-congestion_revenue = kpi_2025["congestion_revenue"].sum()
-avg_distance = kpi_2025["avg_distance"].mean()
+total_trips = after["total_trips"]
+total_revenue = after["total_revenue"]
+congestion_revenue = after["congestion_revenue"]
+avg_distance = after["avg_distance"]
 
 c1, c2, c3, c4 = st.columns(4)
 
@@ -56,110 +47,100 @@ col1, col2 = st.columns(2)
 with col1:
     st.subheader("Trips Trend")
     st.line_chart(
-        monthly_kpis.set_index("month")["total_trips"]
+        monthly_kpis["total_trips"]
     )
 
 with col2:
     st.subheader("Revenue Trend")
     st.line_chart(
-        monthly_kpis.set_index("month")[
+        monthly_kpis[
             ["total_revenue", "congestion_revenue"]
         ]
     )
 st.subheader("Before vs After Congestion Pricing")
 
-# Define policy years
-before = monthly_kpis[monthly_kpis["year"] == 2024]
-after = monthly_kpis[monthly_kpis["year"] == 2025]
-
-if len(before) > 0 and len(after) > 0:
-
-    before_trips = before["total_trips"].sum()
-    after_trips = after["total_trips"].sum()
-
-    before_rev = before["total_revenue"].sum()
-    after_rev = after["total_revenue"].sum()
+if before.notna().all() and after.notna().all():
 
-    before_speed = before["avg_duration_minutes"].mean()
-    after_speed = after["avg_duration_minutes"].mean()
+    # Absolute and percent change for every KPI in one vectorized pass
+    diff = after - before
+    pct = diff / before * 100
 
     c1, c2, c3 = st.columns(3)
 
     c1.metric(
         "Trips Change",
-        f"{after_trips:,.0f}",
-        f"{(after_trips-before_trips)/before_trips*100:.1f}%"
+        f"{after['total_trips']:,.0f}",
+        f"{pct['total_trips']:.1f}%"
     )
 
     c2.metric(
         "Revenue Change ($)",
-        f"{after_rev:,.0f}",
-        f"{(after_rev-before_rev)/before_rev*100:.1f}%"
+        f"{after['total_revenue']:,.0f}",
+        f"{pct['total_revenue']:.1f}%"
     )
 
     c3.metric(
         "Avg Duration Change (min)",
-        f"{after_speed:.2f}",
-        f"{after_speed-before_speed:.2f}"
+        f"{after['avg_duration_minutes']:.2f}",
+        f"{diff['avg_duration_minutes']:.2f}"
     )
 
-# ---------- Tabs ----------
-tab1, tab2, tab3, tab4 = st.tabs([
-    "Border Effect Map",
-    "Traffic Flow",
-    "Economics",
-    "Weather Impact"
-])
-
-# ---------- TAB 1 ----------
-with tab1:
+# ---------- Tab Renderers ----------
+# Each tab reads its own parquet files, so nothing is loaded for a
+# tab until the user opens it.
+def render_border_tab():
     st.header("Border Effect Analysis")
 
-    border_effect = pd.read_parquet(
-        os.path.join(BASE_DIR, "border_effect.parquet")
+    border_effect = load_table(
+        os.path.join(BASE_DIR, "border_effect.parquet"),
+        columns=[
+            "dropoff_loc", "trips_2024",
+            "trips_2025", "percent_change"
+        ]
     )
 
-    if len(border_effect) == 0:
+    if border_effect.num_rows == 0:
         st.warning("No border effect data available.")
     else:
         st.dataframe(border_effect)
 
     st.info("Trips ending near congestion boundary zones.")
 
-# ---------- TAB 2 ----------
-with tab2:
+
+def render_velocity_tab():
     st.header("Velocity Heatmap")
 
-    pivot = velocity.pivot(
-        index="weekday",
-        columns="hour",
-        values="avg_speed"
+    # Pivot is precomputed by the pipeline
+    pivot = load_table(
+        os.path.join(BASE_DIR, "velocity_pivot.parquet")
     )
 
-    st.dataframe(pivot)
+    # weekday is the first column, so the row index is redundant
+    st.dataframe(pivot, hide_index=True)
+
 
-# ---------- TAB 3 ----------
-with tab3:
+def render_economics_tab():
     st.header("Tip vs Surcharge Analysis")
 
-    crowding = pd.read_parquet(
-        os.path.join(BASE_DIR, "crowding_out.parquet")
+    crowding = load_monthly(
+        "crowding",
+        ["avg_surcharge", "avg_tip_ratio"],
+        view_mtime("crowding")
     )
 
-    crowding["month"] = pd.to_datetime(crowding["month"])
+    st.line_chart(crowding)
 
-    st.line_chart(
-        crowding.set_index("month")[
-            ["avg_surcharge", "avg_tip_ratio"]
-        ]
-    )
-
-    # Revenue zones
+    # Revenue zones (top 10 precomputed by the pipeline)
     st.subheader("Top Revenue Pickup Zones")
 
-    top_rev = zone_counts.sort_values(
-        "revenue", ascending=False
-    ).head(10)
+    top_rev = run_query("""
+        SELECT pickup_loc, revenue
+        FROM top_zones
+        ORDER BY revenue DESC
+    """, "top_zones", view_mtime("top_zones"))
+
+    # Zone IDs are labels, so keep them as small category codes
+    top_rev["pickup_loc"] = top_rev["pickup_loc"].astype("category")
 
     st.bar_chart(
         top_rev.set_index("pickup_loc")["revenue"]
@@ -168,30 +149,65 @@ with tab3:
     # Leakage revenue
     st.subheader("Revenue Lost Due to Leakage")
 
-    leakage["month"] = pd.to_datetime(leakage["month"])
-
-    st.line_chart(
-        leakage.set_index("month")["leakage_revenue"]
+    leakage = load_monthly(
+        "leakage",
+        ["leakage_revenue"],
+        view_mtime("leakage")
     )
 
-# ---------- TAB 4 ----------
-with tab4:
+    st.line_chart(leakage["leakage_revenue"])
+
+
+def render_weather_tab():
     st.header("Rain Impact on Taxi Demand")
 
-    rain = pd.read_parquet(
-        os.path.join(BASE_DIR, "rain_tax.parquet")
+    rain = load_table(
+        os.path.join(BASE_DIR, "rain_tax.parquet"),
+        columns=["trip_date", "rainy", "trip_count"]
     )
 
     st.dataframe(rain)
 
     st.subheader("Rain vs Demand")
 
-    # Pipeline outputs avg_trips
+    # Ship only the plotted columns, with the 0/1 flag as int8
+    payload = rain.select(["rainy", "trip_count"]).cast(pa.schema([
+        ("rainy", pa.int8()),
+        ("trip_count", pa.int64())
+    ]))
+
     st.scatter_chart(
-    rain,
-    x="rainy",
-    y="trip_count"
-)
+        payload,
+        x="rainy",
+        y="trip_count"
+    )
+
+
+# ---------- Tabs ----------
+# st.tabs runs every tab body on each rerun, so a selector inside a
+# fragment renders only the open tab and switching tabs reruns just
+# this section, not the KPI block above.
+TABS = {
+    "Border Effect Map": render_border_tab,
+    "Traffic Flow": render_velocity_tab,
+    "Economics": render_economics_tab,
+    "Weather Impact": render_weather_tab
+}
+
+
+@st.fragment
+def render_tabs():
+    selected = st.radio(
+        "View",
+        list(TABS),
+        horizontal=True,
+        label_visibility="collapsed"
+    )
+
+    TABS[selected]()
+
+
+render_tabs()
 
 
 st.success("Dashboard loaded successfully.")
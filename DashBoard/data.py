@@ -0,0 +1,157 @@
+# data.py
+
+# ---------- Imports ----------
+import streamlit as st
+import pandas as pd
+import pyarrow.parquet as pq
+import duckdb
+import os
+import threading
+
+
+# ---------- Base Path ----------
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# DuckDB view name -> pipeline output backing it
+VIEWS = {
+    "monthly": "monthly_kpis.parquet",
+    "top_zones": "top_revenue_zones.parquet",
+    "leakage": "dashboard_leakage.parquet",
+    "crowding": "crowding_out.parquet"
+}
+
+# Narrow dtypes for monthly chart columns. Monthly counts stay far
+# below the int32 limit, and float32 keeps ~7 significant digits,
+# plenty for plotting revenue.
+DTYPES = {
+    "total_trips": "int32",
+    "total_revenue": "float32",
+    "congestion_revenue": "float32",
+    "avg_distance": "float32",
+    "avg_duration_minutes": "float32",
+    "avg_surcharge": "float32",
+    "avg_tip_ratio": "float32",
+    "leakage_trips": "int32",
+    "leakage_revenue": "float32"
+}
+
+# ---------- Cached Loaders ----------
+def view_mtime(view):
+    """
+    Modification time of the parquet file behind a view.
+    Used in cache keys so a pipeline rerun invalidates cached results.
+    """
+    return os.path.getmtime(os.path.join(BASE_DIR, VIEWS[view]))
+
+
+# Three parquet files are read as Arrow tables; room for about two
+# versions of each, so tables superseded by a pipeline rerun are evicted
+@st.cache_resource(max_entries=6)
+def table_store(path, mtime, columns=None):
+    """
+    Arrow tables shared by every session, keyed by path and mtime.
+    """
+    return pq.read_table(path, columns=columns)
+
+
+def load_table(path, columns=None):
+    """
+    Read a parquet file as an Arrow table once per file version.
+    Only the requested columns are decoded, and the table can be
+    handed to Streamlit without a pandas round-trip.
+    """
+    return table_store(path, os.path.getmtime(path), columns)
+
+
+@st.cache_resource
+def get_connection():
+    """
+    Shared DuckDB connection; views are added by ensure_view.
+    """
+    con = duckdb.connect()
+    con.execute("PRAGMA threads=4")
+
+    return con
+
+
+# Views already created on the shared connection
+created_views = set()
+views_lock = threading.Lock()
+
+
+def ensure_view(con, view):
+    """
+    Create a view the first time it is queried. DuckDB opens the
+    parquet file when the view is created, so doing it lazily keeps
+    a missing file from breaking anything but the tab that needs it.
+    """
+    with views_lock:
+        if view in created_views:
+            return
+
+        path = os.path.join(BASE_DIR, VIEWS[view])
+        con.execute(f"""
+            CREATE OR REPLACE VIEW {view} AS
+            SELECT *
+            FROM read_parquet('{path}');
+        """)
+        created_views.add(view)
+
+
+@st.cache_data(ttl=None)
+def run_query(sql, view, mtime):
+    """
+    Run a query against one dashboard view and cache the result frame.
+    mtime is only part of the cache key.
+    """
+    con = get_connection()
+    ensure_view(con, view)
+
+    # Each call gets its own cursor so sessions don't share a connection
+    return con.cursor().execute(sql).df()
+
+
+@st.cache_data(ttl=None)
+def load_monthly(view, columns, mtime):
+    """
+    Load a monthly view indexed by parsed, sorted months.
+    The frame is built once per file version; mtime is only
+    part of the cache key.
+    """
+    df = run_query(f"""
+        SELECT month, {", ".join(columns)}
+        FROM {view}
+        ORDER BY month
+    """, view, mtime)
+    # The pipeline writes month as a TIMESTAMP, so this is normally a no-op
+    if not pd.api.types.is_datetime64_any_dtype(df["month"]):
+        df["month"] = pd.to_datetime(df["month"])
+
+    # Chart series don't need 64-bit precision; yearly totals are
+    # summed in DuckDB before this, so nothing downstream loses digits
+    df = df.astype({col: DTYPES[col] for col in columns if col in DTYPES})
+
+    return df.set_index("month")
+
+
+@st.cache_data(ttl=None)
+def load_yearly_kpis(mtime):
+    """
+    Aggregate 2024 and 2025 KPIs in a single parquet scan.
+    The range filter on the raw month column lets DuckDB skip
+    row groups using parquet footer statistics.
+    mtime is only part of the cache key.
+    """
+    return run_query("""
+        SELECT
+            year(month) AS year,
+            SUM(total_trips) AS total_trips,
+            SUM(total_revenue) AS total_revenue,
+            SUM(congestion_revenue) AS congestion_revenue,
+            AVG(avg_distance) AS avg_distance,
+            AVG(avg_duration_minutes) AS avg_duration_minutes
+        FROM monthly
+        WHERE month >= TIMESTAMP '2024-01-01'
+          AND month < TIMESTAMP '2026-01-01'
+        GROUP BY 1
+    """, "monthly", mtime).set_index("year").reindex([2024, 2025])
@@ -10,26 +10,153 @@ from bs4 import BeautifulSoup
 # os handles folders and file paths
 import os
 
+# json stores HTTP validators between runs
+import json
+
+# time and formatdate decide when a cached page needs revalidating
+import time
+from email.utils import formatdate
+
+# shutil streams response bodies straight to disk
+import shutil
+
+# ThreadPoolExecutor runs network downloads and pipeline stages concurrently
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# threading caps open connections across all downloads
+import threading
+
 # duckdb allows querying parquet files without loading fully
 import duckdb
 
+# psutil reads total RAM to size DuckDB's memory limit
+import psutil
+
 
 # ----------Config----------
 TLC_URL = "https://www.nyc.gov/site/tlc/about/tlc-trip-record-data.page"
 DATA_FOLDER = r"D:\Coding\DataScience\DataScience_Assignment1_NYC_Congestion\data"
 
+# Parallel downloads, capped so the CDN isn't flooded
+MAX_DOWNLOADS = 5
+
+# Large files are fetched as parallel byte ranges
+RANGE_PARTS = 8
+RANGE_MIN_SIZE = 32 << 20
+
+# Open connections across every file and range
+MAX_CONNECTIONS = 16
+connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+# ETag/Last-Modified of every downloaded url, kept next to the data
+HTTP_CACHE = os.path.join(DATA_FOLDER, "http_cache.json")
+http_cache_lock = threading.Lock()
+
+# Pipeline stages allowed to run at the same time
+MAX_STAGES = 4
+
 
 # Ensure folder exists
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
 
+# -------HTTP Cache ----------
+def load_http_cache():
+    """
+    Reads the url -> validators cache, empty on the first run.
+    """
+    if not os.path.exists(HTTP_CACHE):
+        return {}
+
+    with open(HTTP_CACHE) as f:
+        return json.load(f)
+
+
+def update_http_cache(entries):
+    """
+    Merges url -> validators into the cache file. Stages download
+    concurrently, so the read-modify-write is serialized and the
+    file is replaced atomically.
+    """
+    with http_cache_lock:
+        cache = load_http_cache()
+        cache.update(entries)
+
+        partial = HTTP_CACHE + ".part"
+        with open(partial, "w") as f:
+            json.dump(cache, f, indent=2)
+
+        os.replace(partial, HTTP_CACHE)
+
+
+def cache_entry(headers):
+    """
+    Validators worth keeping from a response.
+    """
+    return {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content_length": headers.get("Content-Length")
+    }
+
+
+def validation_headers(entry):
+    """
+    Conditional request headers for a cached entry.
+    """
+    headers = {}
+
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers
+
+
+def cached_get(url, filepath, max_age=3600):
+    """
+    GETs url into filepath. A local copy younger than max_age
+    seconds is used without any request; an older one is only
+    replaced if the server says it changed. Returns filepath.
+    """
+    if not os.path.exists(filepath):
+        entry = {}
+    elif time.time() - os.path.getmtime(filepath) < max_age:
+        return filepath
+    else:
+        # Fall back to the file's own mtime if it predates the cache
+        entry = load_http_cache().get(url) or {
+            "last_modified": formatdate(os.path.getmtime(filepath), usegmt=True)
+        }
+
+    response = requests.get(url, headers=validation_headers(entry))
+
+    if response.status_code == 304:
+        # Restart the freshness window
+        os.utime(filepath)
+        return filepath
+
+    response.raise_for_status()
+
+    with open(filepath, "wb") as f:
+        f.write(response.content)
+
+    update_http_cache({url: cache_entry(response.headers)})
+
+    return filepath
+
+
 # -------Scrape Dataset Links ----------
 def scrape_parquet_links():
     """
     Scrapes TLC website and returns parquet links for 2025.
     """
-    response = requests.get(TLC_URL)
-    soup = BeautifulSoup(response.text, "html.parser")
+    # The page is revalidated, not re-downloaded, on later runs
+    page = cached_get(TLC_URL, os.path.join(DATA_FOLDER, "tlc_trip_records.html"))
+
+    with open(page, encoding="utf-8") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
 
     links = []
     for link in soup.find_all("a"):
@@ -43,23 +170,179 @@ def scrape_parquet_links():
 
 
 # --------Download Files ----------
-def download_files(links):
+def download_whole(url, partial):
     """
-    Downloads parquet files if not already present.
+    Streams url to partial over one connection in 1 MB chunks.
+    """
+    with connection_slots, requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+
+        with open(partial, "wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
+
+
+def download_range(url, partial, start, end):
+    """
+    Writes bytes start..end (inclusive) of url at the same offset in partial.
+    Returns False if the server ignored the Range header.
+    """
+    headers = {"Range": f"bytes={start}-{end}"}
+
+    with connection_slots, requests.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            return False
+
+        # Only write at this offset if the server sent exactly these bytes
+        content_range = r.headers.get("Content-Range", "")
+        if not content_range.startswith(f"bytes {start}-{end}/"):
+            raise Exception(f"Unexpected Content-Range for {url}: {content_range!r}")
+
+        # Ranges are disjoint, so each thread writes through its own handle
+        with open(partial, "r+b") as f:
+            f.seek(start)
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
+
+    return True
+
+
+def download_ranges(url, partial, size):
+    """
+    Downloads url as RANGE_PARTS parallel byte ranges into a
+    pre-sized file. Returns False if ranges aren't supported.
+    """
+    with open(partial, "wb") as f:
+        f.truncate(size)
+
+    step = -(-size // RANGE_PARTS)
+    ranges = [
+        (start, min(start + step, size) - 1)
+        for start in range(0, size, step)
+    ]
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        results = list(pool.map(
+            lambda r: download_range(url, partial, *r),
+            ranges
+        ))
+
+    return all(results)
+
+
+def download_file(url, filepath):
+    """
+    Downloads a single url to filepath, splitting large files
+    into parallel byte ranges when the server allows it.
+    Returns the response validators for the HTTP cache.
+    """
+    # Write to a temp name so an interrupted download isn't
+    # mistaken for a complete file on the next run
+    partial = filepath + ".part"
+
+    head = requests.head(url, allow_redirects=True)
+    head.raise_for_status()
+
+    size = int(head.headers.get("Content-Length", 0))
+
+    # One connection is capped well below the line rate, so big
+    # files go over several when the server advertises range
+    # support; anything else is a plain GET
+    use_ranges = (
+        size >= RANGE_MIN_SIZE
+        and head.headers.get("Accept-Ranges") == "bytes"
+    )
+
+    if not use_ranges or not download_ranges(url, partial, size):
+        download_whole(url, partial)
+
+    os.replace(partial, filepath)
+
+    return cache_entry(head.headers)
+
+
+def revalidate(url, filepath, entry):
+    """
+    Conditional HEAD for a file already on disk.
+    Returns fresh validators if the local copy is current, else None.
+    If the server can't be asked, the local copy is kept.
     """
-    for url in links:
-        filename = url.split("/")[-1]
-        filepath = os.path.join(DATA_FOLDER, filename)
+    filename = os.path.basename(filepath)
+
+    try:
+        r = requests.head(url, headers=validation_headers(entry), allow_redirects=True)
+    except requests.RequestException as e:
+        print("Warning: could not revalidate", filename, "-", e)
+        return entry
+
+    if r.status_code == 304:
+        return entry
+
+    if not r.ok:
+        print("Warning: could not revalidate", filename, "- HTTP", r.status_code)
+        return entry
+
+    # A plain 200 still counts as current when the size matches and
+    # the ETag (if we ever stored one) hasn't changed
+    same_size = r.headers.get("Content-Length") == str(os.path.getsize(filepath))
+    same_etag = not entry.get("etag") or r.headers.get("ETag") == entry["etag"]
+
+    if same_size and same_etag:
+        return cache_entry(r.headers)
 
-        if not os.path.exists(filepath):
-            print("Downloading:", filename)
+    return None
 
-            data = requests.get(url).content
-            with open(filepath, "wb") as f:
-                f.write(data)
 
-        else:
+def sync_file(url, filepath, entry, message):
+    """
+    Downloads url unless the local copy is still current.
+    Returns the validators describing the local copy.
+    """
+    filename = os.path.basename(filepath)
+
+    if os.path.exists(filepath):
+        current = revalidate(url, filepath, entry)
+
+        if current is not None:
             print("Already exists:", filename)
+            return current
+
+    print(message, filename)
+    return download_file(url, filepath)
+
+
+def download_parallel(urls, message):
+    """
+    Syncs files concurrently, at most MAX_DOWNLOADS at a time.
+    Files already on disk cost one HEAD request instead of a GET.
+    """
+    cache = load_http_cache()
+
+    jobs = [
+        (url, os.path.join(DATA_FOLDER, url.split("/")[-1]))
+        for url in urls
+    ]
+
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as pool:
+        # list() waits for every download and re-raises any failure
+        entries = list(pool.map(
+            lambda job: sync_file(*job, cache.get(job[0], {}), message),
+            jobs
+        ))
+
+    # Workers only return validators; the cache is written once here
+    update_http_cache({
+        url: entry
+        for (url, _), entry in zip(jobs, entries)
+    })
+
+
+def download_files(links):
+    """
+    Downloads parquet files if not already present.
+    """
+    download_parallel(links, "Downloading:")
 
 
 # -----Detect Missing December ----------
@@ -85,20 +368,10 @@ def download_if_missing(year, month):
         f"https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_{year}-{month}.parquet"
     ]
 
-    for url in base_urls:
-        filename = url.split("/")[-1]
-        filepath = os.path.join(DATA_FOLDER, filename)
-
-        if not os.path.exists(filepath):
-            print("Downloading required file:", filename)
-            data = requests.get(url).content
-            with open(filepath, "wb") as f:
-                f.write(data)
-        else:
-            print("Already exists:", filename)
+    download_parallel(base_urls, "Downloading required file:")
 
 
-def impute_december_if_missing():
+def impute_december_if_missing(con):
     """
     Detect missing December 2025 and compute
     weighted December using 2023 and 2024 data.
@@ -113,8 +386,6 @@ def impute_december_if_missing():
     download_if_missing("2023", "12")
     download_if_missing("2024", "12")
 
-    con = duckdb.connect()
-
     files_2023 = [
         os.path.join(DATA_FOLDER, "yellow_tripdata_2023-12.parquet"),
         os.path.join(DATA_FOLDER, "green_tripdata_2023-12.parquet")
@@ -130,40 +401,66 @@ def impute_december_if_missing():
         if not os.path.exists(f):
             raise Exception(f"Required file missing: {f}")
 
-    stats23 = con.execute(f"""
-        SELECT
-            COUNT(*) AS trips,
-            AVG(trip_distance) AS avg_distance,
-            AVG(fare_amount) AS avg_fare,
-            AVG(total_amount) AS avg_total,
-            AVG(congestion_surcharge) AS avg_surcharge
-        FROM read_parquet({files_2023})
-    """).fetchdf()
-
-    stats24 = con.execute(f"""
-        SELECT
-            COUNT(*) AS trips,
-            AVG(trip_distance) AS avg_distance,
-            AVG(fare_amount) AS avg_fare,
-            AVG(total_amount) AS avg_total,
-            AVG(congestion_surcharge) AS avg_surcharge
-        FROM read_parquet({files_2024})
-    """).fetchdf()
-
-    weighted = 0.3 * stats23 + 0.7 * stats24
-
-    weighted.to_parquet("imputed_december_2025.parquet")
+    # Weight both Decembers and write the result without leaving DuckDB
+    con.execute(f"""
+        COPY (
+            SELECT
+                0.3 * s23.trips + 0.7 * s24.trips AS trips,
+                0.3 * s23.avg_distance + 0.7 * s24.avg_distance AS avg_distance,
+                0.3 * s23.avg_fare + 0.7 * s24.avg_fare AS avg_fare,
+                0.3 * s23.avg_total + 0.7 * s24.avg_total AS avg_total,
+                0.3 * s23.avg_surcharge + 0.7 * s24.avg_surcharge AS avg_surcharge
+            FROM (
+                SELECT
+                    CAST(COUNT(*) AS DOUBLE) AS trips,
+                    AVG(trip_distance) AS avg_distance,
+                    AVG(fare_amount) AS avg_fare,
+                    AVG(total_amount) AS avg_total,
+                    AVG(congestion_surcharge) AS avg_surcharge
+                FROM read_parquet({files_2023})
+            ) s23,
+            (
+                SELECT
+                    CAST(COUNT(*) AS DOUBLE) AS trips,
+                    AVG(trip_distance) AS avg_distance,
+                    AVG(fare_amount) AS avg_fare,
+                    AVG(total_amount) AS avg_total,
+                    AVG(congestion_surcharge) AS avg_surcharge
+                FROM read_parquet({files_2024})
+            ) s24
+        )
+        TO 'imputed_december_2025.parquet'
+        (FORMAT PARQUET);
+    """)
 
     print("Imputed December statistics saved.")
 
 
 #-----Unified Schema ----------
-def create_unified_schema():
+def trip_files(color):
     """
-    Standardize schema and preserve taxi type and tips.
+    Monthly files for one taxi color from 2023 onwards, listed once
+    so DuckDB gets explicit paths instead of globbing the folder.
     """
+    prefix = f"{color}_tripdata_"
+
+    return sorted(
+        os.path.join(DATA_FOLDER, name)
+        for name in os.listdir(DATA_FOLDER)
+        if name.startswith(prefix)
+        and name.endswith(".parquet")
+        and name >= prefix + "2023"
+    )
+
 
-    con = duckdb.connect()
+def create_unified_schema(con):
+    """
+    Standardize schema and preserve taxi type and tips.
+    Column projection and the year filter sit directly on the
+    parquet scan so DuckDB can prune row groups and columns.
+    Pickup year and month are stored once as small integers so
+    later stages filter on them instead of re-extracting.
+    """
 
     # Yellow taxi
     yellow_query = f"""
@@ -171,14 +468,21 @@ def create_unified_schema():
             'Yellow' AS taxi_type,
             tpep_pickup_datetime AS pickup_time,
             tpep_dropoff_datetime AS dropoff_time,
-            PULocationID AS pickup_loc,
-            DOLocationID AS dropoff_loc,
+            CAST(EXTRACT(YEAR FROM tpep_pickup_datetime) AS SMALLINT) AS pickup_year,
+            CAST(EXTRACT(MONTH FROM tpep_pickup_datetime) AS TINYINT) AS pickup_month,
+            CAST(PULocationID AS INTEGER) AS pickup_loc,
+            CAST(DOLocationID AS INTEGER) AS dropoff_loc,
             trip_distance,
             fare_amount AS fare,
             tip_amount,
             total_amount,
             congestion_surcharge
-        FROM read_parquet('{DATA_FOLDER}/yellow_*.parquet')
+        FROM read_parquet(
+            {trip_files("yellow")},
+            hive_partitioning = false,
+            union_by_name = true
+        )
+        WHERE tpep_pickup_datetime >= TIMESTAMP '2023-01-01'
     """
 
     # Green taxi
@@ -187,14 +491,21 @@ def create_unified_schema():
             'Green' AS taxi_type,
             lpep_pickup_datetime AS pickup_time,
             lpep_dropoff_datetime AS dropoff_time,
-            PULocationID AS pickup_loc,
-            DOLocationID AS dropoff_loc,
+            CAST(EXTRACT(YEAR FROM lpep_pickup_datetime) AS SMALLINT) AS pickup_year,
+            CAST(EXTRACT(MONTH FROM lpep_pickup_datetime) AS TINYINT) AS pickup_month,
+            CAST(PULocationID AS INTEGER) AS pickup_loc,
+            CAST(DOLocationID AS INTEGER) AS dropoff_loc,
             trip_distance,
             fare_amount AS fare,
             tip_amount,
             total_amount,
             congestion_surcharge
-        FROM read_parquet('{DATA_FOLDER}/green_*.parquet')
+        FROM read_parquet(
+            {trip_files("green")},
+            hive_partitioning = false,
+            union_by_name = true
+        )
+        WHERE lpep_pickup_datetime >= TIMESTAMP '2023-01-01'
     """
 
     con.execute(f"""
@@ -204,100 +515,103 @@ def create_unified_schema():
         {green_query}
     """)
 
-    con.execute("""
-        COPY unified_trips TO 'unified_trips.parquet'
-        (FORMAT PARQUET);
-    """)
-
     print("Unified dataset created successfully.")
 
 
 #---- Ghost Trip Filter-----
-def ghost_trip_filter():
+def ghost_trip_filter(con):
     """
     Detect fraudulent trips and create audit logs.
     """
 
-    con = duckdb.connect()
-
-    print("Loading unified dataset...")
-
-    # Load unified parquet file instead of table
-    con.execute("""
-        CREATE OR REPLACE TABLE trips_with_metrics AS
-        SELECT *,
-            EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 60
-                AS duration_minutes,
-
-            CASE
-                WHEN EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) > 0
-                THEN trip_distance /
-                     (EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 3600)
-                ELSE 0
-            END AS avg_speed_mph
-       FROM read_parquet('unified_trips.parquet')
-WHERE EXTRACT(YEAR FROM pickup_time) >= 2023;
-
-    """)
-
     print("Detecting ghost trips...")
 
+    # Add duration and speed, then label every trip. A view, so the
+    # labelled trips are never held in memory alongside clean_trips
     con.execute("""
-        CREATE OR REPLACE TABLE ghost_trips AS
-        SELECT *
-        FROM trips_with_metrics
-        WHERE
+        CREATE OR REPLACE TEMP VIEW trips_with_metrics AS
+        SELECT *,
             avg_speed_mph > 65
             OR (duration_minutes < 1 AND fare > 20)
-            OR (trip_distance = 0 AND fare > 0);
+            OR (trip_distance = 0 AND fare > 0)
+                AS is_ghost
+        FROM (
+            SELECT *,
+                EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 60
+                    AS duration_minutes,
+
+                CASE
+                    WHEN EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) > 0
+                    THEN trip_distance /
+                         (EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 3600)
+                    ELSE 0
+                END AS avg_speed_mph
+            FROM unified_trips
+        );
     """)
 
+    # Trip-level outputs are written once and scanned many times:
+    # ZSTD shrinks them and large row groups cut per-group metadata
     con.execute("""
-        COPY ghost_trips TO 'audit_log.parquet'
-        (FORMAT PARQUET);
+        COPY (
+            SELECT * EXCLUDE (is_ghost)
+            FROM trips_with_metrics
+            WHERE is_ghost
+        )
+        TO 'audit_log.parquet'
+        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1000000);
     """)
 
+    # The one trip table every analysis stage reads
     con.execute("""
         CREATE OR REPLACE TABLE clean_trips AS
-        SELECT *
+        SELECT * EXCLUDE (is_ghost)
         FROM trips_with_metrics
-        WHERE NOT (
-            avg_speed_mph > 65
-            OR (duration_minutes < 1 AND fare > 20)
-            OR (trip_distance = 0 AND fare > 0)
-        );
+        WHERE NOT is_ghost;
     """)
 
+    # Written as a pickup_year=/pickup_month= hive dataset so readers
+    # filtering on a period only open the matching directories.
+    # OVERWRITE clears partitions left over from earlier runs.
     con.execute("""
-        COPY clean_trips TO 'clean_trips.parquet'
-        (FORMAT PARQUET);
+        COPY clean_trips
+        TO 'clean_trips'
+        (
+            FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1000000,
+            PARTITION_BY (pickup_year, pickup_month), OVERWRITE TRUE
+        );
     """)
 
     print("Ghost trip filtering completed.")
 
+
+def release_unified_trips(con):
+    """
+    Drop the raw unified trips once every stage reading them is done.
+    """
+    con.execute("DROP TABLE unified_trips")
+
+
     #-----Build Congestion Zone------
-def build_congestion_zone_reference():
+def build_congestion_zone_reference(con):
     """
-    Identify congestion zone LocationIDs.
+    Identify congestion zone LocationIDs and return them.
     """
 
     lookup_url = "https://d37ci6vzurychx.cloudfront.net/misc/taxi_zone_lookup.csv"
     lookup_path = os.path.join(DATA_FOLDER, "taxi_zone_lookup.csv")
 
-    # Download lookup if missing
-    if not os.path.exists(lookup_path):
-        print("Downloading taxi zone lookup...")
-        data = requests.get(lookup_url).content
-        with open(lookup_path, "wb") as f:
-            f.write(data)
-
-    con = duckdb.connect()
+    # The zone list almost never changes, so revalidate weekly
+    cached_get(lookup_url, lookup_path, max_age=7 * 24 * 3600)
 
     # Load lookup data
     con.execute(f"""
-        CREATE OR REPLACE TABLE taxi_zones AS
+        CREATE OR REPLACE VIEW taxi_zones AS
         SELECT *
-        FROM read_csv_auto('{lookup_path}');
+        FROM read_csv_auto(
+            '{lookup_path}',
+            types = {{'LocationID': 'INTEGER'}}
+        );
     """)
 
     # Manhattan zones approximation
@@ -322,47 +636,35 @@ AND Zone NOT LIKE '%Washington Heights%';
 
     print("Congestion zone mapping created.")
 
+    # ~60 IDs: small enough to inline as constant IN-lists downstream
+    return [
+        row[0] for row in
+        con.execute("SELECT LocationID FROM congestion_zone").fetchall()
+    ]
+
 #----Leakage Audit---
-def congestion_leakage_audit():
+def congestion_leakage_audit(con, zone_ids):
     """
     Compute surcharge compliance and leakage.
     """
 
-    con = duckdb.connect()
-
-    # Load clean trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
-
-    # Load congestion zone IDs
-    con.execute("""
-        CREATE OR REPLACE TABLE zones AS
-        SELECT *
-        FROM read_parquet('congestion_zone.parquet');
-    """)
+    zone_list = ", ".join(map(str, zone_ids))
 
     # Trips entering congestion zone
-    con.execute("""
-        CREATE OR REPLACE TABLE entering_zone AS
-        SELECT t.*
-        FROM trips t
-        LEFT JOIN zones p
-            ON t.pickup_loc = p.LocationID
-        LEFT JOIN zones d
-            ON t.dropoff_loc = d.LocationID
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE entering_zone AS
+        SELECT *
+        FROM clean_trips
         WHERE
-            p.LocationID IS NULL
-            AND d.LocationID IS NOT NULL
-            AND EXTRACT(YEAR FROM pickup_time) >= 2024;
-
+            pickup_year >= 2024
+            AND dropoff_loc IN ({zone_list})
+            -- NOT IN is NULL for a missing pickup; keep those trips
+            AND (pickup_loc IS NULL OR pickup_loc NOT IN ({zone_list}));
     """)
 
     # Compliance stats
     con.execute("""
-        CREATE OR REPLACE TABLE compliance_stats AS
+        CREATE OR REPLACE TEMP TABLE compliance_stats AS
         SELECT
             COUNT(*) AS total_entering,
             SUM(
@@ -376,7 +678,7 @@ def congestion_leakage_audit():
 
     # Leakage trips
     con.execute("""
-        CREATE OR REPLACE TABLE leakage_trips AS
+        CREATE OR REPLACE TEMP TABLE leakage_trips AS
         SELECT *
         FROM entering_zone
         WHERE congestion_surcharge IS NULL
@@ -385,7 +687,7 @@ def congestion_leakage_audit():
 
     # Top leakage pickup zones
     con.execute("""
-        CREATE OR REPLACE TABLE top_leakage_pickups AS
+        CREATE OR REPLACE TEMP TABLE top_leakage_pickups AS
         SELECT
             pickup_loc,
             COUNT(*) AS leakage_count
@@ -395,15 +697,28 @@ def congestion_leakage_audit():
         LIMIT 3;
     """)
 
+    # Monthly leakage for the dashboard, aggregated while
+    # leakage_trips is still in memory
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE monthly_leakage AS
+        SELECT
+            DATE_TRUNC('month', pickup_time) AS month,
+            COUNT(*) AS leakage_trips,
+            SUM(total_amount) AS leakage_revenue
+        FROM leakage_trips
+        GROUP BY 1
+        ORDER BY 1;
+    """)
+
     # Save outputs
     con.execute("""
         COPY leakage_trips
         TO 'leakage_trips.parquet'
-        (FORMAT PARQUET);
+        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1000000);
     """)
 
     con.execute("""
-        COPY top_leakage_pickups
+        COPY (SELECT * FROM top_leakage_pickups ORDER BY leakage_count DESC)
         TO 'top_leakage_pickups.parquet'
         (FORMAT PARQUET);
     """)
@@ -414,44 +729,39 @@ def congestion_leakage_audit():
         (FORMAT PARQUET);
     """)
 
+    con.execute("""
+        COPY (SELECT * FROM monthly_leakage ORDER BY month)
+        TO 'dashboard_leakage.parquet'
+        (FORMAT PARQUET);
+    """)
+
     print("Correct leakage audit completed.")
 
 
 #----KPI Comuptation----
-def compute_kpis():
+def compute_kpis(con):
     """
     Compute aggregated KPIs for analysis and dashboard.
     """
 
-    con = duckdb.connect()
-
-    # Load clean trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
-
     # Monthly aggregation
     con.execute("""
-        CREATE OR REPLACE TABLE monthly_kpis AS
+        CREATE OR REPLACE TEMP TABLE monthly_kpis AS
         SELECT
             DATE_TRUNC('month', pickup_time) AS month,
             COUNT(*) AS total_trips,
             SUM(total_amount) AS total_revenue,
             SUM(congestion_surcharge) AS congestion_revenue,
             AVG(trip_distance) AS avg_distance,
-            AVG(
-                EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 60
-            ) AS avg_duration_minutes
-        FROM trips
+            AVG(duration_minutes) AS avg_duration_minutes
+        FROM clean_trips
         GROUP BY 1
         ORDER BY 1;
     """)
 
     # Save aggregated results
     con.execute("""
-        COPY monthly_kpis
+        COPY (SELECT * FROM monthly_kpis ORDER BY month)
         TO 'monthly_kpis.parquet'
         (FORMAT PARQUET);
     """)
@@ -459,115 +769,83 @@ def compute_kpis():
     print("KPI aggregation completed.")
 
 #---DashBoard Dataset-----
-def prepare_dashboard_datasets():
+def prepare_dashboard_datasets(con):
     """
     Prepare aggregated datasets for dashboards.
     """
 
-    con = duckdb.connect()
-
-    # Load clean trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
-
     # Trips per pickup zone
     con.execute("""
-        CREATE OR REPLACE TABLE zone_trip_counts AS
+        CREATE OR REPLACE TEMP TABLE zone_trip_counts AS
         SELECT
             pickup_loc,
             COUNT(*) AS trip_count,
             SUM(total_amount) AS revenue
-        FROM trips
+        FROM clean_trips
         GROUP BY pickup_loc
         ORDER BY trip_count DESC;
     """)
 
-    # Leakage summary per month
-    con.execute("""
-        CREATE OR REPLACE TABLE leakage AS
-        SELECT *
-        FROM read_parquet('leakage_trips.parquet');
-    """)
-
+    # Top revenue pickup zones
     con.execute("""
-        CREATE OR REPLACE TABLE monthly_leakage AS
+        CREATE OR REPLACE TEMP TABLE top_revenue_zones AS
         SELECT
-            DATE_TRUNC('month', pickup_time) AS month,
-            COUNT(*) AS leakage_trips,
-            SUM(total_amount) AS leakage_revenue
-        FROM leakage
-        GROUP BY 1
-        ORDER BY 1;
+            pickup_loc,
+            revenue
+        FROM zone_trip_counts
+        ORDER BY revenue DESC
+        LIMIT 10;
     """)
 
     # Save dashboard datasets
     con.execute("""
-        COPY zone_trip_counts
+        COPY (SELECT * FROM zone_trip_counts ORDER BY trip_count DESC)
         TO 'dashboard_zone_counts.parquet'
         (FORMAT PARQUET);
     """)
 
     con.execute("""
-        COPY monthly_leakage
-        TO 'dashboard_leakage.parquet'
+        COPY (SELECT * FROM top_revenue_zones ORDER BY revenue DESC)
+        TO 'top_revenue_zones.parquet'
         (FORMAT PARQUET);
     """)
 
     print("Dashboard datasets prepared.")
 
 #----Yellow Green Decline------
-def yellow_green_decline():
+def yellow_green_decline(con, zone_ids):
     """
     Compare Q1 2024 vs Q1 2025 zone entry volumes.
     """
 
-    con = duckdb.connect()
-
-    # Load unified data
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('unified_trips.parquet');
-    """)
+    zone_list = ", ".join(map(str, zone_ids))
 
-    # Load congestion zones
-    con.execute("""
-        CREATE OR REPLACE TABLE zones AS
+    # Trips entering zone, before ghost filtering; named apart from
+    # the leakage audit's entering_zone since both stages run at once
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE entering_zone_all AS
         SELECT *
-        FROM read_parquet('congestion_zone.parquet');
-    """)
-
-    # Trips entering zone
-    con.execute("""
-        CREATE OR REPLACE TABLE entering_zone AS
-        SELECT t.*
-        FROM trips t
-        LEFT JOIN zones p
-            ON t.pickup_loc = p.LocationID
-        LEFT JOIN zones d
-            ON t.dropoff_loc = d.LocationID
+        FROM unified_trips
         WHERE
-            p.LocationID IS NULL
-            AND d.LocationID IS NOT NULL;
+            dropoff_loc IN ({zone_list})
+            -- NOT IN is NULL for a missing pickup; keep those trips
+            AND (pickup_loc IS NULL OR pickup_loc NOT IN ({zone_list}));
     """)
 
     # Filter Q1
     con.execute("""
-        CREATE OR REPLACE TABLE q1_data AS
+        CREATE OR REPLACE TEMP TABLE q1_data AS
         SELECT
             taxi_type,
-            EXTRACT(YEAR FROM pickup_time) AS year
-        FROM entering_zone
-        WHERE EXTRACT(MONTH FROM pickup_time) IN (1,2,3)
-          AND EXTRACT(YEAR FROM pickup_time) IN (2024, 2025);
+            pickup_year AS year
+        FROM entering_zone_all
+        WHERE pickup_month IN (1,2,3)
+          AND pickup_year IN (2024, 2025);
     """)
 
     # Aggregate
     con.execute("""
-        CREATE OR REPLACE TABLE q1_comparison AS
+        CREATE OR REPLACE TEMP TABLE q1_comparison AS
         SELECT
             taxi_type,
             year,
@@ -586,40 +864,17 @@ def yellow_green_decline():
     print("Yellow vs Green decline analysis completed.")
 
 #--- Border Effect Choropleth----    
-def border_effect_analysis():
+def border_effect_analysis(con):
     """
     Compute percent change in dropoffs outside congestion zone.
     """
 
-    con = duckdb.connect()
-
-    # Load clean trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
-
-    # Load congestion zones
-    con.execute("""
-        CREATE OR REPLACE TABLE zones AS
-        SELECT *
-        FROM read_parquet('congestion_zone.parquet');
-    """)
-
-    # Load zone lookup
-    con.execute(f"""
-        CREATE OR REPLACE TABLE lookup AS
-        SELECT *
-        FROM read_csv_auto('{DATA_FOLDER}/taxi_zone_lookup.csv');
-    """)
-
     # Manhattan zones outside congestion zone
     con.execute("""
-        CREATE OR REPLACE TABLE border_zones AS
+        CREATE OR REPLACE TEMP TABLE border_zones AS
 SELECT l.LocationID
-FROM lookup l
-LEFT JOIN zones z
+FROM taxi_zones l
+LEFT JOIN congestion_zone z
     ON l.LocationID = z.LocationID
 WHERE l.Borough = 'Manhattan'
 AND z.LocationID IS NULL;
@@ -629,48 +884,38 @@ AND z.LocationID IS NULL;
 
     # Dropoffs in border zones
     con.execute("""
-        CREATE OR REPLACE TABLE border_dropoffs AS
+        CREATE OR REPLACE TEMP TABLE border_dropoffs AS
         SELECT
             dropoff_loc,
-            EXTRACT(YEAR FROM pickup_time) AS year
-        FROM trips t
+            pickup_year AS year
+        FROM clean_trips t
         JOIN border_zones b
-           ON CAST(t.dropoff_loc AS INTEGER) = CAST(b.LocationID AS INTEGER)
+           ON t.dropoff_loc = b.LocationID
 
-       WHERE EXTRACT(YEAR FROM pickup_time) IN (2024, 2025);
+       WHERE pickup_year IN (2024, 2025);
 
     """)
 
-    # Aggregate counts
+    # Count both years and compute percent change in one aggregation
     con.execute("""
-        CREATE OR REPLACE TABLE border_counts AS
+        CREATE OR REPLACE TEMP TABLE border_change AS
         SELECT
             dropoff_loc,
-            year,
-            COUNT(*) AS trips
-        FROM border_dropoffs
-        GROUP BY dropoff_loc, year;
-    """)
-
-    # Compute percent change
-    con.execute("""
-        CREATE OR REPLACE TABLE border_change AS
-SELECT
-    COALESCE(a.dropoff_loc, b.dropoff_loc) AS dropoff_loc,
-    COALESCE(a.trips, 0) AS trips_2024,
-    COALESCE(b.trips, 0) AS trips_2025,
-    CASE
-        WHEN COALESCE(a.trips,0) > 0
-        THEN 100.0 * (COALESCE(b.trips,0) - a.trips) / a.trips
-        ELSE NULL
-    END AS percent_change
-FROM
-    (SELECT * FROM border_counts WHERE year = 2024) a
-FULL OUTER JOIN
-    (SELECT * FROM border_counts WHERE year = 2025) b
-ON a.dropoff_loc = b.dropoff_loc;
-
-
+            trips_2024,
+            trips_2025,
+            CASE
+                WHEN trips_2024 > 0
+                THEN 100.0 * (trips_2025 - trips_2024) / trips_2024
+                ELSE NULL
+            END AS percent_change
+        FROM (
+            SELECT
+                dropoff_loc,
+                COUNT(*) FILTER (WHERE year = 2024) AS trips_2024,
+                COUNT(*) FILTER (WHERE year = 2025) AS trips_2025
+            FROM border_dropoffs
+            GROUP BY dropoff_loc
+        );
     """)
 
     # Save result
@@ -683,54 +928,35 @@ ON a.dropoff_loc = b.dropoff_loc;
     print("Border effect analysis completed.")
 
 #---Velocity Heatmap----
-def congestion_velocity_heatmap():
+def congestion_velocity_heatmap(con, zone_ids):
     """
     Compute average speed heatmap for congestion zone.
     """
 
-    con = duckdb.connect()
-
-    # Load trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
+    # Trips occurring inside congestion zone
+    zone_list = ", ".join(map(str, zone_ids))
 
-    # Load congestion zone IDs
-    con.execute("""
-        CREATE OR REPLACE TABLE zones AS
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE zone_trips AS
         SELECT *
-        FROM read_parquet('congestion_zone.parquet');
-    """)
-
-    # Trips occurring inside congestion zone
-    con.execute("""
-        CREATE OR REPLACE TABLE zone_trips AS
-        SELECT t.*
-        FROM trips t
-        JOIN zones z
-            ON t.pickup_loc = z.LocationID;
+        FROM clean_trips
+        WHERE pickup_loc IN ({zone_list});
     """)
 
-    # Compute speed and extract time features
+    # Extract time features (speed was computed by the ghost filter)
     con.execute("""
-        CREATE OR REPLACE TABLE speed_metrics AS
+        CREATE OR REPLACE TEMP TABLE speed_metrics AS
         SELECT
             EXTRACT(HOUR FROM pickup_time) AS hour,
             EXTRACT(DOW FROM pickup_time) AS weekday,
-            CASE
-                WHEN EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) > 0
-                THEN trip_distance /
-                     (EXTRACT(EPOCH FROM (dropoff_time - pickup_time)) / 3600)
-                ELSE NULL
-            END AS speed_mph
-        FROM zone_trips;
+            avg_speed_mph AS speed_mph
+        FROM zone_trips
+        WHERE duration_minutes > 0;
     """)
 
     # Aggregate speeds
     con.execute("""
-        CREATE OR REPLACE TABLE heatmap_data AS
+        CREATE OR REPLACE TEMP TABLE heatmap_data AS
         SELECT
             weekday,
             hour,
@@ -747,26 +973,35 @@ def congestion_velocity_heatmap():
         (FORMAT PARQUET);
     """)
 
+    # Weekday x hour grid for the dashboard (explicit hours keep column order)
+    hours = ", ".join(str(h) for h in range(24))
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE heatmap_pivot AS
+        PIVOT heatmap_data
+        ON hour IN ({hours})
+        USING AVG(avg_speed)
+        GROUP BY weekday
+        ORDER BY weekday;
+    """)
+
+    con.execute("""
+        COPY (SELECT * FROM heatmap_pivot ORDER BY weekday)
+        TO 'velocity_pivot.parquet'
+        (FORMAT PARQUET);
+    """)
+
     print("Velocity heatmap data prepared.")
 
 #----Crowding Out Analysis----
-def crowding_out_analysis():
+def crowding_out_analysis(con):
     """
     Analyze impact of congestion surcharge on tipping.
     """
 
-    con = duckdb.connect()
-
-    # Load clean trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
-
     # Compute tipping metrics
     con.execute("""
-        CREATE OR REPLACE TABLE tipping_data AS
+        CREATE OR REPLACE TEMP TABLE tipping_data AS
         SELECT
             DATE_TRUNC('month', pickup_time) AS month,
             congestion_surcharge,
@@ -775,12 +1010,12 @@ def crowding_out_analysis():
                 THEN tip_amount / fare
                 ELSE NULL
             END AS tip_ratio
-        FROM trips;
+        FROM clean_trips;
     """)
 
     # Aggregate monthly
     con.execute("""
-        CREATE OR REPLACE TABLE tipping_summary AS
+        CREATE OR REPLACE TEMP TABLE tipping_summary AS
         SELECT
             month,
             AVG(congestion_surcharge) AS avg_surcharge,
@@ -793,7 +1028,7 @@ def crowding_out_analysis():
 
     # Save output
     con.execute("""
-        COPY tipping_summary
+        COPY (SELECT * FROM tipping_summary ORDER BY month)
         TO 'crowding_out.parquet'
         (FORMAT PARQUET);
     """)
@@ -801,13 +1036,11 @@ def crowding_out_analysis():
     print("Crowding out analysis completed.")
 
 #---Rain tax Analysis----
-def rain_tax_analysis():
+def rain_tax_analysis(con):
     """
     Analyze effect of rain on taxi demand using NYC weather.
     """
 
-    import pandas as pd
-
     # Central Park, NYC coordinates
     weather_url = (
         "https://archive-api.open-meteo.com/v1/archive"
@@ -824,48 +1057,42 @@ def rain_tax_analysis():
     # Download weather if missing
     if not os.path.exists(weather_path):
         print("Downloading NYC weather data...")
-        weather_json = requests.get(weather_url).json()
-
-        weather_df = pd.DataFrame({
-            "trip_date": weather_json["daily"]["time"],
-            "precipitation": weather_json["daily"]["precipitation_sum"]
-        })
-
-        weather_df["trip_date"] = pd.to_datetime(
-            weather_df["trip_date"]
-        ).dt.date
-
-        weather_df.to_parquet(weather_path)
-
-    con = duckdb.connect()
-
-    # Load taxi trips
-    con.execute("""
-        CREATE OR REPLACE TABLE trips AS
-        SELECT *
-        FROM read_parquet('clean_trips.parquet');
-    """)
+        json_path = cached_get(
+            weather_url,
+            os.path.join(DATA_FOLDER, "ny_weather.json")
+        )
+
+        # DuckDB reads the raw response; the two daily arrays
+        # are unnested side by side into one row per day
+        con.execute(f"""
+            COPY (
+                SELECT
+                    CAST(unnest(daily.time) AS DATE) AS trip_date,
+                    unnest(daily.precipitation_sum) AS precipitation
+                FROM read_json_auto('{json_path}')
+            ) TO '{weather_path}' (FORMAT PARQUET);
+        """)
 
     # Daily trip counts
     con.execute("""
-        CREATE OR REPLACE TABLE daily_trips AS
+        CREATE OR REPLACE TEMP TABLE daily_trips AS
         SELECT
             DATE(pickup_time) AS trip_date,
             COUNT(*) AS trip_count
-        FROM trips
+        FROM clean_trips
         GROUP BY trip_date;
     """)
 
     # Load NYC weather
     con.execute(f"""
-        CREATE OR REPLACE TABLE weather AS
+        CREATE OR REPLACE TEMP VIEW weather AS
         SELECT *
         FROM read_parquet('{weather_path}');
     """)
 
     # Join weather and trips
     con.execute("""
-        CREATE OR REPLACE TABLE rain_analysis AS
+        CREATE OR REPLACE TEMP TABLE rain_analysis AS
         SELECT
             d.trip_date,
             d.trip_count,
@@ -880,7 +1107,7 @@ def rain_tax_analysis():
 
     # Aggregate rain impact
     con.execute("""
-        CREATE OR REPLACE TABLE rain_summary AS
+        CREATE OR REPLACE TEMP TABLE rain_summary AS
 SELECT
     trip_date,
     rainy,
@@ -899,35 +1126,120 @@ FROM rain_analysis;
     print("Rain tax analysis completed.")
 
 
+# ---------- DuckDB Settings ----------
+def configure_duckdb(con):
+    """
+    Tune the shared connection for a local batch ETL run.
+    """
+
+    memory_mb = int(psutil.virtual_memory().total * 0.7 // 2**20)
+    temp_dir = os.path.join(DATA_FOLDER, "duckdb_tmp")
+
+    con.execute(f"SET threads = {os.cpu_count()}")
+    con.execute(f"SET memory_limit = '{memory_mb}MB'")
+
+    # Spill large joins/aggregations to disk instead of failing
+    con.execute(f"SET temp_directory = '{temp_dir}'")
+
+    # Lets parallel queries skip the final ordered gather;
+    # outputs that need an order sort explicitly in their COPY
+    con.execute("SET preserve_insertion_order = false")
+
+    con.execute("PRAGMA enable_object_cache")
+    con.execute("PRAGMA disable_progress_bar")
+
+
 # ---------- Pipeline Runner ----------
-def run_ingestion():
+def run_stages(con, stages, results):
+    """
+    Runs each stage as soon as all of its dependencies have finished.
+    stages maps name -> (function, [dependency names]); every function
+    gets its own cursor, and its return value is stored in results.
+    """
+    def run(name, func):
+        # A cursor is a separate connection to the same database,
+        # so concurrent stages share tables and the buffer pool
+        cursor = con.cursor()
+        try:
+            results[name] = func(cursor)
+        finally:
+            cursor.close()
 
-    links = scrape_parquet_links()
-    download_files(links)
+    running = {}
 
-    impute_december_if_missing()
+    with ThreadPoolExecutor(max_workers=MAX_STAGES) as pool:
+        while len(results) < len(stages):
+            started = set(running.values())
 
-    create_unified_schema()
+            for name, (func, deps) in stages.items():
+                ready = all(dep in results for dep in deps)
 
-    ghost_trip_filter()
+                if name not in results and name not in started and ready:
+                    running[pool.submit(run, name, func)] = name
 
-    build_congestion_zone_reference()
+            # Nothing running and nothing ready: a dependency is
+            # misspelled or circular, and waiting would spin forever
+            if not running:
+                pending = sorted(set(stages) - set(results))
+                raise Exception(f"Stages can never run: {pending}")
 
-    congestion_leakage_audit()
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
 
-    yellow_green_decline()
+            for future in finished:
+                # Re-raise a failed stage instead of waiting forever
+                future.result()
+                del running[future]
 
-    compute_kpis()
 
-    border_effect_analysis()
+def run_ingestion():
 
-    congestion_velocity_heatmap()
+    # One connection for every stage so parquet metadata and
+    # the buffer pool are reused instead of rebuilt per stage
+    con = duckdb.connect(":memory:")
+    configure_duckdb(con)
 
-    crowding_out_analysis()
+    links = scrape_parquet_links()
+    download_files(links)
 
-    rain_tax_analysis()
-    
-    prepare_dashboard_datasets()
+    results = {}
+
+    def zones():
+        return results["zone_reference"]
+
+    # Stage -> (function, stages it needs). DuckDB parallelizes inside
+    # a query; this keeps cores busy across the many small ones.
+    # Stage-local tables are TEMP on the stage's cursor, so they are
+    # freed when the stage finishes.
+    stages = {
+        "impute": (impute_december_if_missing, []),
+        # Reads the December 2023 files the imputation downloads
+        "unified": (create_unified_schema, ["impute"]),
+        "ghost": (ghost_trip_filter, ["unified"]),
+        "zone_reference": (build_congestion_zone_reference, []),
+        "leakage": (
+            lambda cur: congestion_leakage_audit(cur, zones()),
+            ["ghost", "zone_reference"]
+        ),
+        "yellow_green": (
+            lambda cur: yellow_green_decline(cur, zones()),
+            ["unified", "zone_reference"]
+        ),
+        "kpis": (compute_kpis, ["ghost"]),
+        "border": (border_effect_analysis, ["ghost", "zone_reference"]),
+        "velocity": (
+            lambda cur: congestion_velocity_heatmap(cur, zones()),
+            ["ghost", "zone_reference"]
+        ),
+        "crowding": (crowding_out_analysis, ["ghost"]),
+        "rain": (rain_tax_analysis, ["ghost"]),
+        "dashboard": (prepare_dashboard_datasets, ["ghost"]),
+        "release_unified": (
+            release_unified_trips,
+            ["ghost", "yellow_green"]
+        )
+    }
+
+    run_stages(con, stages, results)
 
 
 